@@ -2,19 +2,23 @@ import os
 import time
 import torch
 import socket
+import contextlib
 import argparse
 import subprocess
 
 import torch.nn as nn
 import torch.distributed as dist
+import torchvision
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 import torchvision.models as models
 
-from typing import Tuple
+from typing import Callable, Optional, Tuple
 from torch.optim import SGD
 from torch.optim.optimizer import Optimizer
+from torch.optim.lr_scheduler import CosineAnnealingLR, LinearLR, SequentialLR
 from torch.utils.data import DataLoader
+from torchvision.io import read_file
 from torch.utils.data.distributed import DistributedSampler
 from torch.nn.parallel import DistributedDataParallel
 
@@ -41,23 +45,101 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class Prefetcher(object):
+    """Copies the next batch to the GPU on a side stream while the current one is being processed.
+
+    The loader is expected to yield uint8 images, they are scaled to [0, 1] and
+    passed through `transform` (batched GPU augmentations) on the side stream.
+    If `decode` is given the loader yields lists of encoded images instead, which
+    `decode` turns into a uint8 batch on the GPU.
+    """
+
+    def __init__(self,
+                 loader: DataLoader,
+                 transform: Optional[nn.Module] = None,
+                 decode: Optional[Callable] = None):
+        self.loader = iter(loader)
+        self.transform = transform
+        self.decode = decode
+        self.stream = torch.cuda.Stream()
+        self.preload()
+
+    def preload(self):
+        try:
+            self.next_input, self.next_target = next(self.loader)
+        except StopIteration:
+            self.next_input = None
+            self.next_target = None
+            return
+
+        # the loader pins its batches, so these copies are asynchronous
+        with torch.cuda.stream(self.stream):
+            if self.decode is not None:
+                self.next_input = self.decode(self.next_input)
+            else:
+                self.next_input = self.next_input.cuda(non_blocking=True)
+            self.next_target = self.next_target.cuda(non_blocking=True)
+            self.next_input = self.next_input.float().div_(255.)
+            if self.transform is not None:
+                self.next_input = self.transform(self.next_input)
+            self.next_input = self.next_input.contiguous(memory_format=torch.channels_last)
+
+    def next(self):
+        torch.cuda.current_stream().wait_stream(self.stream)
+        input, target = self.next_input, self.next_target
+        if input is not None:
+            # the batch was allocated on the side stream, tell the caching allocator
+            # it is now in use on the compute stream so its memory is not reused too early
+            input.record_stream(torch.cuda.current_stream())
+            target.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return input, target
+
+
+class HostStaging(object):
+    """Copies small GPU tensors to a pinned host buffer on a side stream.
+
+    `put` only enqueues the copy, `get` waits on the host (not the device) for
+    it to finish and returns the values. A single copy can be in flight at a time.
+    """
+
+    def __init__(self, size: int):
+        self.host_buf = torch.empty(size, dtype=torch.float32, pin_memory=True)
+        self.stream = torch.cuda.Stream()
+        self.done_evt = None
+
+    def put(self, tensor: torch.Tensor):
+        self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            self.host_buf.copy_(tensor, non_blocking=True)
+            # the tensor was allocated on the compute stream
+            tensor.record_stream(self.stream)
+            self.done_evt = self.stream.record_event()
+
+    def get(self):
+        self.done_evt.synchronize()
+        return self.host_buf.tolist()
+
+
 def accuracy(output, target, topk=(1,5)):
     """Computes the accuracy over the k top predictions for the specified values of k"""
     maxk = max(topk)
     batch_size = target.size(0)
     _, pred = output.topk(maxk, 1, True, True)
-    pred = pred.t()
-    correct = pred.eq(target.reshape(1, -1).expand_as(pred))
-    return [correct[:k].reshape(-1).float().sum(0) * 100. / batch_size for k in topk]
+    # hits per rank summed over the batch in one reduction, the cumulative
+    # sum then gives the number of top-k hits for every k at once
+    correct = pred.eq(target.view(-1, 1)).float().sum(0).cumsum(0)
+    return [correct[k - 1] * 100. / batch_size for k in topk]
 
 
 
 def reduce_tensor(tensor: torch.Tensor, world_size: int):
-    """Reduce tensor across all nodes."""
-    rt = tensor.clone()
-    dist.all_reduce(rt, op=dist.ReduceOp.SUM)
-    rt /= world_size
-    return rt
+    """Reduce tensor across all nodes.
+
+    The tensor is averaged in place and returned.
+    """
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.div_(world_size)
 
 
 def to_python_float(t: torch.Tensor):
@@ -68,147 +150,240 @@ def to_python_float(t: torch.Tensor):
 
 
 def train(train_loader: DataLoader,
+          train_augment: nn.Module,
           model: nn.Module,
           criterion: nn.Module,
           optimizer: Optimizer,
+          scaler: torch.cuda.amp.GradScaler,
+          amp_dtype: torch.dtype,
           epoch: int,
           world_size: int,
           is_master: bool,
-          log_interval: int = 100):
+          log_interval: int = 100,
+          accum_steps: int = 1,
+          train_decode: Optional[Callable] = None):
     batch_time = AverageMeter()
     data_time = AverageMeter()
-    losses = AverageMeter()
-    top1 = AverageMeter()
-    top5 = AverageMeter()
+
+    # The stats of a log step are copied to the host in the background and
+    # printed at the next log step (or at the end of the epoch).
+    staging = HostStaging(6)
+    pending = None
+
+    # Preallocated buffer for the logging allreduce, which runs asynchronously
+    # and is only waited for after the next iteration's backward pass.
+    reduce_buf = torch.empty(3, device='cuda')
+    reduce_work = None
+
+    # Running sums of loss / prec@1 / prec@5 weighted by batch size, kept on the
+    # GPU since to_python_float would incur a host<->device sync.
+    sums = torch.zeros(3, device='cuda')
+    count = 0
+
+    # [values, averages] snapshot of a log step, the source of the host staging copy
+    log_buf = torch.empty(6, device='cuda')
+
+    def print_log(i, n_iter, batch_size, start_evt, end_evt):
+        # waits on the host for the copy (and thus both events) to complete
+        loss_val, top1_val, top5_val, loss_avg, top1_avg, top5_avg = staging.get()
+        # average time per iteration since the previous log line
+        batch_time.update(start_evt.elapsed_time(end_evt) / 1000. / n_iter, n_iter)
+        print(
+            f"Epoch: [{epoch}][{i}/{len(train_loader)}]\t"
+            f"Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t"
+            f"Speed {world_size * batch_size / batch_time.val:.3f} ({world_size * batch_size / batch_time.avg:.3f})\t"
+            f"Loss {loss_val:.10f} ({loss_avg:.4f})\t"
+            f"Prec@1 {top1_val:.3f} ({top1_avg:.3f})\t"
+            f"Prec@5 {top5_val:.3f} ({top5_avg:.3f})"
+        )
+
+    def log_reduced(i, batch_size, end_evt):
+        nonlocal pending, prev_i, prev_evt, count
+        reduce_work.wait()
+        reduce_buf.div_(world_size)
+
+        sums.add_(reduce_buf, alpha=batch_size)
+        count += batch_size
+
+        # Only the first node should log infos.
+        if is_master:
+            # print the previous log step before its staging buffer is reused
+            if pending is not None:
+                print_log(*pending)
+
+            log_buf[:3].copy_(reduce_buf)
+            torch.div(sums, count, out=log_buf[3:])
+            staging.put(log_buf)
+            pending = (i, i - prev_i, batch_size, prev_evt, end_evt)
+            prev_i, prev_evt = i, end_evt
 
     # switch to train mode
     model.train()
 
+    # Timing uses CUDA events recorded on the compute stream, they are only read
+    # one log step later so the host never waits on the GPU to measure speed.
+    prev_i, prev_evt = -1, torch.cuda.Event(enable_timing=True)
+    prev_evt.record()
+
     end = time.time()
-    for i, (input, target) in enumerate(train_loader):
+    prefetcher = Prefetcher(train_loader, train_augment, train_decode)
+    input, target = prefetcher.next()
+    i = 0
+    optimizer.zero_grad(set_to_none=True)
+    while input is not None:
 
         # measure data loading time
         data_time.update(time.time() - end)
 
-        # Create non_blocking tensors for distributed training
-        input = input.cuda(non_blocking=True)
-        target = target.cuda(non_blocking=True)
-
-        # compute output
-        output = model(input)
-        loss = criterion(output, target)
+        # Gradients are accumulated over accum_steps batches, only the last one
+        # of each window triggers the DDP allreduce and the optimizer step. The last
+        # batch of the epoch always steps, its window may be shorter.
+        is_sync = (i + 1) % accum_steps == 0 or i + 1 == len(train_loader)
+        window = min(accum_steps, len(train_loader) - i // accum_steps * accum_steps)
+        with contextlib.nullcontext() if is_sync else model.no_sync():
+            # compute output in mixed precision
+            with torch.cuda.amp.autocast(dtype=amp_dtype):
+                output = model(input)
+                loss = criterion(output, target)
 
-        # print(output.shape, target.shape)
-        # compute gradients in a backward pass
-        optimizer.zero_grad()
-        loss.backward()
+            # print(output.shape, target.shape)
+            # compute gradients in a backward pass on the scaled loss
+            scaler.scale(loss / window).backward()
 
-        # Call step of optimizer to update model params
-        optimizer.step()
+        if reduce_work is not None:
+            # the logging allreduce issued at the previous iteration
+            log_reduced(*reduce_log)
+            reduce_work = None
 
-        if i % log_interval == 0:
+        is_log = i % log_interval == 0
+        if is_log:
             # Every log_freq iterations, check the loss, accuracy, and speed.
             # For best performance, it doesn't make sense to print these metrics every
             # iteration, since they incur an allreduce and some host<->device syncs.
 
             # Measure accuracy
-            prec1, prec5 = accuracy(output.data, target.data, topk=(1, 5))
+            prec1, prec5 = accuracy(output.detach(), target, topk=(1, 5))
 
-            # Average loss and accuracy across processes for logging
-            reduced_loss = reduce_tensor(loss.data, world_size)
-            prec1 = reduce_tensor(prec1, world_size)
-            prec5 = reduce_tensor(prec5, world_size)
+            torch.stack([loss.detach(), prec1, prec5], out=reduce_buf)
 
-            # to_python_float incurs a host<->device sync
-            batch_size = input[0].size(0)
-            losses.update(to_python_float(reduced_loss), batch_size)
-            top1.update(to_python_float(prec1), batch_size)
-            top5.update(to_python_float(prec5), batch_size)
+        # Release the graph and activations before the optimizer step so the
+        # allocator can reuse them, the log stats are already in reduce_buf.
+        del output, loss
 
-            torch.cuda.synchronize()
-            batch_time.update((time.time() - end) / log_interval)
-            end = time.time()
+        if is_sync:
+            # Call step of optimizer (through the scaler) to update model params
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
 
-            # Only the first node should log infos.
-            if is_master:
-                print(
-                    f"Epoch: [{epoch}][{i}/{len(train_loader)}]\t"
-                    f"Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t"
-                    f"Speed {world_size * batch_size / batch_time.val:.3f} ({world_size * batch_size / batch_time.avg:.3f})\t"
-                    f"Loss {losses.val:.10f} ({losses.avg:.4f})\t"
-                    f"Prec@1 {top1.val:.3f} ({top1.avg:.3f})\t"
-                    f"Prec@5 {top5.val:.3f} ({top5.avg:.3f})"
-                )
+        if is_log:
+            # Average loss and accuracy across processes for logging, in a single allreduce
+            reduce_work = dist.all_reduce(reduce_buf, op=dist.ReduceOp.SUM, async_op=True)
 
+            end_evt = torch.cuda.Event(enable_timing=True)
+            end_evt.record()
+            reduce_log = (i, input.size(0), end_evt)
 
-def adjust_learning_rate(initial_lr: float,
-                         optimizer: Optimizer,
-                         epoch: int):
-    """Sets the learning rate to the initial LR decayed by 10 every 30 epochs"""
-    lr = initial_lr * (0.1 ** (epoch // 75))
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
+        i += 1
+        end = time.time()
+        input, target = prefetcher.next()
+
+    if reduce_work is not None:
+        log_reduced(*reduce_log)
+    if pending is not None:
+        print_log(*pending)
 
 
 def validate(val_loader: DataLoader,
+             val_augment: nn.Module,
              model: nn.Module,
              criterion: nn.Module,
+             amp_dtype: torch.dtype,
              world_size: int,
              is_master: bool,
-             log_freq: int = 100):
+             log_freq: int = 100,
+             val_decode: Optional[Callable] = None):
     batch_time = AverageMeter()
-    losses = AverageMeter()
-    top1 = AverageMeter()
-    top5 = AverageMeter()
+
+    # log lines are queued with their stats still on the GPU (one row of
+    # [values, averages] per line) and printed at the end
+    log_queue = []
+    log_stats = torch.empty(len(val_loader) // log_freq + 1, 6, device='cuda')
+
+    # preallocated buffer for the logging allreduce
+    reduce_buf = torch.empty(3, device='cuda')
+
+    # see train() for the running sums
+    sums = torch.zeros(3, device='cuda')
+    count = 0
 
     # switch to evaluate mode
     model.eval()
 
-    with torch.no_grad():
-        end = time.time()
-        for i, (input, target) in enumerate(val_loader):
+    # see train() for the event based timing
+    start_evt = torch.cuda.Event(enable_timing=True)
+    start_evt.record()
 
-            input = input.cuda(non_blocking=True)
-            target = target.cuda(non_blocking=True)
+    with torch.no_grad():
+        prefetcher = Prefetcher(val_loader, val_augment, val_decode)
+        input, target = prefetcher.next()
+        i = 0
+        while input is not None:
 
-            with torch.no_grad():
+            with torch.cuda.amp.autocast(dtype=amp_dtype):
                 # compute output
                 output = model(input)
                 loss = criterion(output, target)
 
             # Measure accuracy
-            prec1, prec5 = accuracy(output.data, target.data, topk=(1, 5))
+            prec1, prec5 = accuracy(output.detach(), target, topk=(1, 5))
 
-            # Average loss and accuracy across processes for logging
-            reduced_loss = reduce_tensor(loss.data, world_size)
-            prec1 = reduce_tensor(prec1, world_size)
-            prec5 = reduce_tensor(prec5, world_size)
+            # Average loss and accuracy across processes for logging, in a single allreduce
+            torch.stack([loss.detach(), prec1, prec5], out=reduce_buf)
+            reduce_tensor(reduce_buf, world_size)
 
-            # to_python_float incurs a host<->device sync
-            batch_size = input[0].size(0)
-            losses.update(to_python_float(reduced_loss), batch_size)
-            top1.update(to_python_float(prec1), batch_size)
-            top5.update(to_python_float(prec5), batch_size)
-
-            torch.cuda.synchronize()
-            batch_time.update((time.time() - end) / log_freq)
-            end = time.time()
+            batch_size = input.size(0)
+            sums.add_(reduce_buf, alpha=batch_size)
+            count += batch_size
 
             if i % log_freq == 0 and is_master:
                 # Only the first node should log infos.
+                end_evt = torch.cuda.Event(enable_timing=True)
+                end_evt.record()
+                row = log_stats[len(log_queue)]
+                row[:3].copy_(reduce_buf)
+                torch.div(sums, count, out=row[3:])
+                log_queue.append((i, batch_size, end_evt))
+
+            i += 1
+            input, target = prefetcher.next()
+
+        if is_master and log_queue:
+            # a single host<->device sync for the whole validation pass, after which all events have completed
+            stats = log_stats[:len(log_queue)].tolist()
+            prev_i, prev_evt = -1, start_evt
+            for (i, batch_size, end_evt), (loss_val, top1_val, top5_val, loss_avg, top1_avg, top5_avg) \
+                    in zip(log_queue, stats):
+                # average time per iteration since the previous log line
+                n_iter = i - prev_i
+                batch_time.update(prev_evt.elapsed_time(end_evt) / 1000. / n_iter, n_iter)
+                prev_i, prev_evt = i, end_evt
+                time_val, time_avg = batch_time.val, batch_time.avg
                 print(
                     f"Test: [{i}/{len(val_loader)}]\t"
-                    f"Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t"
-                    f"Speed {world_size * batch_size / batch_time.val:.3f} ({world_size * batch_size / batch_time.avg:.3f})\t"
-                    f"Loss {losses.val:.10f} ({losses.avg:.4f})\t"
-                    f"Prec@1 {top1.val:.3f} ({top1.avg:.3f})\t"
-                    f"Prec@5 {top5.val:.3f} ({top5.avg:.3f})"
+                    f"Time {time_val:.3f} ({time_avg:.3f})\t"
+                    f"Speed {world_size * batch_size / time_val:.3f} ({world_size * batch_size / time_avg:.3f})\t"
+                    f"Loss {loss_val:.10f} ({loss_avg:.4f})\t"
+                    f"Prec@1 {top1_val:.3f} ({top1_avg:.3f})\t"
+                    f"Prec@5 {top5_val:.3f} ({top5_avg:.3f})"
                 )
 
+        # incurs a host<->device sync
+        top1_avg, top5_avg = (sums[1:] / count).tolist()
         if is_master:
-            print(f' * Prec@1 {top1.avg:.3f} Prec@5 {top5.avg:.3f}')
+            print(f' * Prec@1 {top1_avg:.3f} Prec@5 {top5_avg:.3f}')
 
-    return top1.avg
+    return top1_avg
 
 
 def run(data_dir: str,
@@ -217,7 +392,13 @@ def run(data_dir: str,
         epochs: int,
         learning_rate: float,
         log_interval: int,
-        save_model: bool):
+        save_model: bool,
+        gpu_decode: bool,
+        accum_steps: int,
+        sync_bn: bool):
+    # input sizes never change, let cudnn pick the fastest convolution algorithms
+    torch.backends.cudnn.benchmark = True
+
     # number of nodes / node ID
     n_nodes = int(os.environ['SLURM_JOB_NUM_NODES'])
     node_id = int(os.environ['SLURM_NODEID'])
@@ -261,6 +442,15 @@ def run(data_dir: str,
     # set GPU device
     torch.cuda.set_device(local_rank)
 
+    # NCCL tuning, anything already set in the job environment takes precedence.
+    # Tree allreduce has log(n) latency and wins on many nodes, ring stays
+    # optimal for a couple of GPUs, in between NCCL picks the algorithm itself.
+    if n_nodes > 8:
+        os.environ.setdefault('NCCL_ALGO', 'Tree')
+    elif world_size <= 2:
+        os.environ.setdefault('NCCL_ALGO', 'Ring')
+    os.environ.setdefault('NCCL_MIN_NCHANNELS', '4')
+
     print("Initializing PyTorch distributed ...")
     torch.distributed.init_process_group(
         init_method='env://',
@@ -270,65 +460,134 @@ def run(data_dir: str,
     print("Initialize Model...")
     # Construct Model
     model = ResNet()
-    model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+    # SyncBatchNorm adds collectives to every BN layer, it only pays off when the
+    # per-GPU batch is too small for good batch statistics
+    use_sync_bn = batch_size < 32 or sync_bn
+    if use_sync_bn:
+        model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
     model = model.cuda()
+    # NHWC layout lets cudnn pick Tensor Core kernels for the convolutions
+    model = model.to(memory_format=torch.channels_last)
     # Make model DistributedDataParallel
-    model = DistributedDataParallel(model, device_ids=[local_rank], output_device=local_rank)
+    # - larger buckets coalesce the gradients into fewer, bandwidth-bound allreduces
+    # - gradients are views into the allreduce buckets, saving a copy per bucket
+    # - the graph is the same at every step, which lets DDP skip unused-parameter checks
+    # - SyncBatchNorm keeps the running statistics identical on every rank, plain
+    #   BatchNorm needs rank 0's buffers broadcast so all ranks validate the same model
+    model = DistributedDataParallel(model,
+                                    device_ids=[local_rank],
+                                    output_device=local_rank,
+                                    bucket_cap_mb=50,
+                                    gradient_as_bucket_view=True,
+                                    static_graph=True,
+                                    broadcast_buffers=not use_sync_bn)
+    # Let Inductor fuse the conv/bn/relu chains, input shapes are fixed so the graph stays hot
+    model = torch.compile(model, mode='max-autotune', fullgraph=False)
 
     # define loss function (criterion) and optimizer
-    criterion = nn.CrossEntropyLoss().cuda()
-    optimizer = SGD(model.parameters(), learning_rate, momentum=0.9, weight_decay=1e-4)
+    criterion = nn.CrossEntropyLoss(label_smoothing=0.1).cuda()
+    # foreach=True updates all parameters with a handful of multi-tensor kernels
+    optimizer = SGD(model.parameters(), learning_rate, momentum=0.9, weight_decay=1e-4, foreach=True)
+    # bf16 has the fp32 range and needs no loss scaling on Ampere and newer,
+    # older GPUs use fp16 with a loss scaler kept across epochs
+    amp_dtype = torch.bfloat16 if torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
+    # linear warmup from lr / 10 over the first epochs, then cosine decay, stepped once per epoch.
+    # A single epoch run has no room for warmup and trains at the base lr.
+    if epochs > 1:
+        warmup_epochs = min(5, epochs - 1)
+        scheduler = SequentialLR(optimizer,
+                                 [LinearLR(optimizer, start_factor=0.1, end_factor=1.0, total_iters=warmup_epochs),
+                                  CosineAnnealingLR(optimizer, T_max=epochs - warmup_epochs)],
+                                 milestones=[warmup_epochs])
+    else:
+        scheduler = CosineAnnealingLR(optimizer, T_max=epochs)
 
     print("Initialize Dataloaders...")
     
-    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    jittering = util.ColorJitter(brightness=0.4, contrast=0.4,
-                                  saturation=0.4)
-    lighting = util.Lighting(alphastd=0.1,
-                              eigval=[0.2175, 0.0188, 0.0045],
-                              eigvec=[[-0.5675, 0.7192, 0.4009],
-                                      [-0.5808, -0.0045, -0.8140],
-                                      [-0.5836, -0.6948, 0.4203]])
-
+    # Only decoding, cropping and flipping happen in the workers, the loaders yield
+    # uint8 batches that are jittered and normalized on the GPU by the prefetcher.
+    normalize = util.BatchNormalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    jittering = util.BatchColorJitter(brightness=0.4, contrast=0.4,
+                                      saturation=0.4)
+    lighting = util.BatchLighting(alphastd=0.1,
+                                  eigval=[0.2175, 0.0188, 0.0045],
+                                  eigvec=[[-0.5675, 0.7192, 0.4009],
+                                          [-0.5808, -0.0045, -0.8140],
+                                          [-0.5836, -0.6948, 0.4203]])
+
+    train_augment = nn.Sequential(jittering, lighting, normalize).cuda()
+    val_augment = nn.Sequential(normalize).cuda()
 
     transform_train =  transforms.Compose([
             transforms.RandomResizedCrop(224),
             transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            jittering,
-            lighting,
-            normalize,
+            transforms.PILToTensor(),
         ])
 
 
     transform_test = transforms.Compose([
         transforms.Resize(256),
         transforms.CenterCrop(224),
-        transforms.ToTensor(),
-        transforms.Normalize((0.485, 0.456, 0.406),
-                             (0.229, 0.224, 0.225)),
+        transforms.PILToTensor(),
     ])
 
     
-    trainset = datasets.ImageFolder(root=os.path.join(data_dir, 'train'), transform=transform_train)
-    valset = datasets.ImageFolder(root=os.path.join(data_dir, 'val'), transform=transform_test)
+    if gpu_decode:
+        # The workers only read the raw JPEG bytes, decoding and cropping happen
+        # on the GPU (nvjpeg) in the prefetcher.
+        trainset = datasets.ImageFolder(root=os.path.join(data_dir, 'train'), loader=read_file)
+        valset = datasets.ImageFolder(root=os.path.join(data_dir, 'val'), loader=read_file)
+        train_decode = util.BatchDecodeJpeg(transforms.Compose([
+            transforms.RandomResizedCrop(224, antialias=True),
+            transforms.RandomHorizontalFlip(),
+        ]))
+        val_decode = util.BatchDecodeJpeg(transforms.Compose([
+            transforms.Resize(256, antialias=True),
+            transforms.CenterCrop(224),
+        ]))
+        collate_fn = util.collate_encoded
+    else:
+        trainset = datasets.ImageFolder(root=os.path.join(data_dir, 'train'), transform=transform_train)
+        valset = datasets.ImageFolder(root=os.path.join(data_dir, 'val'), transform=transform_test)
+        train_decode = val_decode = None
+        collate_fn = None
 
     # Create DistributedSampler to handle distributing the dataset across nodes
     # This can only be called after torch.distributed.init_process_group is called
     train_sampler = DistributedSampler(trainset)
     val_sampler = DistributedSampler(valset)
 
-    # Create the Dataloaders to feed data to the training and validation steps
+    # Workers per process. train() and validate() run one after the other and idle
+    # persistent workers cost no CPU, so each pool is sized on its own: training
+    # gets the task's CPUs minus one for the main process, validation a few.
+    cpus_per_task = int(os.environ.get('SLURM_CPUS_PER_TASK', os.cpu_count() // n_gpu_per_node))
+    train_workers = max(1, min(8, cpus_per_task - 1))
+    val_workers = max(1, min(4, cpus_per_task // 4))
+
+    # Create the Dataloaders to feed data to the training and validation steps.
+    # Dropping the last partial training batch keeps the input shape fixed for the compiled model.
     train_loader = DataLoader(trainset,
                               batch_size=batch_size,
-                              num_workers=10,
+                              num_workers=train_workers,
                               sampler=train_sampler,
-                              pin_memory=True)
+                              collate_fn=collate_fn,
+                              drop_last=True,
+                              pin_memory=True,
+                              pin_memory_device=f'cuda:{local_rank}',
+                              persistent_workers=True,
+                              prefetch_factor=4,
+                              multiprocessing_context='forkserver')
     val_loader = DataLoader(valset,
                             batch_size=batch_size,
-                            num_workers=10,
+                            num_workers=val_workers,
                             sampler=val_sampler,
-                            pin_memory=True)
+                            collate_fn=collate_fn,
+                            pin_memory=True,
+                            pin_memory_device=f'cuda:{local_rank}',
+                            persistent_workers=True,
+                            prefetch_factor=4,
+                            multiprocessing_context='forkserver')
 
     best_prec1 = 0
 
@@ -339,14 +598,16 @@ def run(data_dir: str,
         # to shuffle for validation.
         train_sampler.set_epoch(epoch)
 
-        # Adjust learning rate according to schedule
-        adjust_learning_rate(learning_rate, optimizer, epoch)
-
         # train for one epoch
-        train(train_loader, model, criterion, optimizer, epoch, world_size, is_master, log_interval)
+        train(train_loader, train_augment, model, criterion, optimizer, scaler, amp_dtype, epoch, world_size, is_master, log_interval,
+              accum_steps=accum_steps, train_decode=train_decode)
+
+        # Adjust learning rate according to schedule
+        scheduler.step()
 
         # evaluate on validation set
-        prec1 = validate(val_loader, model, criterion, world_size, is_master)
+        prec1 = validate(val_loader, val_augment, model, criterion, amp_dtype, world_size, is_master,
+                         val_decode=val_decode)
 
         # remember best prec@1 and save checkpoint if desired
         if prec1 > best_prec1:
@@ -377,7 +638,19 @@ if __name__ == "__main__":
                         help='how many batches to wait before logging training status')
     parser.add_argument('--save-model', action='store_true', default=False,
                         help='For Saving the current Model')
+    parser.add_argument('--accum-steps', type=int, default=1, metavar='N',
+                        help='number of batches to accumulate gradients over before each optimizer step (default: 1)')
+    parser.add_argument('--sync-bn', action='store_true', default=False,
+                        help='use SyncBatchNorm (always on for batch sizes below 32)')
+    parser.add_argument('--gpu-decode', action='store_true', default=False,
+                        help='decode the JPEGs on the GPU with nvjpeg (requires torchvision >= 0.19)')
     args = parser.parse_args()
+    if args.epochs < 1:
+        parser.error('--epochs must be at least 1')
+    if args.gpu_decode:
+        tv_version = tuple(int(v) for v in torchvision.__version__.split('+')[0].split('.')[:2])
+        if tv_version < (0, 19):
+            parser.error(f'--gpu-decode requires torchvision >= 0.19, found {torchvision.__version__}')
 
     run(data_dir = args.data_dir,
         save_dir = args.save_dir,
@@ -385,4 +658,7 @@ if __name__ == "__main__":
         epochs = args.epochs,
         learning_rate = args.lr,
         log_interval = args.log_interval,
-        save_model = args.save_model)
+        save_model = args.save_model,
+        gpu_decode = args.gpu_decode,
+        accum_steps = args.accum_steps,
+        sync_bn = args.sync_bn)
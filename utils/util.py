@@ -20,7 +20,8 @@ from PIL import ImageFilter, ImageOps, Image, ImageDraw
 
 # original code: https://github.com/eladhoffer/convNet.pytorch/blob/master/preprocess.py
 
-__all__ = ["Compose", "Lighting", "ColorJitter"]
+__all__ = ["Compose", "Lighting", "ColorJitter", "BatchLighting", "BatchColorJitter", "BatchNormalize",
+           "BatchDecodeJpeg", "collate_encoded"]
 
 
 class Compose(object):
@@ -138,6 +139,119 @@ class ColorJitter(object):
         return transform(img)
 
 
+# Batched versions of the transforms above, meant to run on the GPU on
+# (N, 3, H, W) float batches in [0, 1] instead of per-sample in the workers.
+
+class BatchLighting(nn.Module):
+    """Lighting noise(AlexNet - style PCA - based noise) on a batch of images"""
+
+    def __init__(self, alphastd, eigval, eigvec):
+        super().__init__()
+        self.alphastd = alphastd
+        self.register_buffer('eigval', torch.Tensor(eigval))
+        self.register_buffer('eigvec', torch.Tensor(eigvec))
+
+    def forward(self, img):
+        if self.alphastd == 0:
+            return img
+
+        alpha = img.new_empty(img.size(0), 3).normal_(0, self.alphastd)
+        rgb = (alpha * self.eigval) @ self.eigvec.t()
+        return img.add_(rgb.view(-1, 3, 1, 1))
+
+
+class BatchColorJitter(nn.Module):
+    """Brightness / contrast / saturation jitter with one random factor per image.
+
+    The order of the three transforms is shuffled once per batch.
+    """
+
+    def __init__(self, brightness=0.4, contrast=0.4, saturation=0.4):
+        super().__init__()
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+
+    @staticmethod
+    def _grayscale(img):
+        return (0.299 * img[:, 0] + 0.587 * img[:, 1] + 0.114 * img[:, 2]).unsqueeze(1)
+
+    @staticmethod
+    def _alpha(img, var):
+        return img.new_empty(img.size(0), 1, 1, 1).uniform_(-var, var)
+
+    def _apply_brightness(self, img):
+        return img.mul_(1 - self._alpha(img, self.brightness))
+
+    def _apply_contrast(self, img):
+        gs = self._grayscale(img).mean(dim=(1, 2, 3), keepdim=True)
+        return img.lerp_(gs.expand_as(img), self._alpha(img, self.contrast))
+
+    def _apply_saturation(self, img):
+        gs = self._grayscale(img)
+        return img.lerp_(gs.expand_as(img), self._alpha(img, self.saturation))
+
+    def forward(self, img):
+        transforms = []
+        if self.brightness != 0:
+            transforms.append(self._apply_brightness)
+        if self.contrast != 0:
+            transforms.append(self._apply_contrast)
+        if self.saturation != 0:
+            transforms.append(self._apply_saturation)
+
+        random.shuffle(transforms)
+        for t in transforms:
+            img = t(img)
+        return img
+
+
+class BatchNormalize(nn.Module):
+    """Normalize a batch of images with per-channel mean and std"""
+
+    def __init__(self, mean, std):
+        super().__init__()
+        self.register_buffer('mean', torch.Tensor(mean).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.Tensor(std).view(1, 3, 1, 1))
+
+    def forward(self, img):
+        return img.sub_(self.mean).div_(self.std)
+
+
+class BatchDecodeJpeg(object):
+    """Decodes a list of encoded JPEGs on the GPU and crops them into a uint8 batch.
+
+    `transform` is applied to each decoded image separately and must return
+    images of the same size. Images nvjpeg cannot decode (e.g. the CMYK JPEGs
+    of ImageNet) are decoded on the CPU instead. Requires torchvision >= 0.19.
+    """
+
+    def __init__(self, transform, device='cuda'):
+        self.transform = transform
+        self.device = device
+
+    def _decode_one(self, data):
+        try:
+            return torchvision.io.decode_jpeg(data, mode=torchvision.io.ImageReadMode.RGB, device=self.device)
+        except RuntimeError:
+            img = torchvision.io.decode_image(data, mode=torchvision.io.ImageReadMode.RGB)
+            return img.to(self.device, non_blocking=True)
+
+    def __call__(self, data):
+        try:
+            images = torchvision.io.decode_jpeg(data, mode=torchvision.io.ImageReadMode.RGB, device=self.device)
+        except RuntimeError:
+            # the batched call fails as a whole, find the offending images one by one
+            images = [self._decode_one(d) for d in data]
+        return torch.stack([self.transform(img) for img in images])
+
+
+def collate_encoded(batch):
+    """Collates (encoded image, target) pairs, keeping the variable length images as a list"""
+    data, targets = zip(*batch)
+    return list(data), torch.tensor(targets)
+
+
 
 def load_pretrained_weights(model, pretrained_weights, checkpoint_key, model_name, patch_size):
     if os.path.isfile(pretrained_weights):